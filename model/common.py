@@ -1,5 +1,12 @@
 import math, copy, torch
 import torch.nn as nn
+import torch.nn.functional as F
+from dataclasses import dataclass
+
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError:
+    flash_attn_varlen_func = None
 
 
 
@@ -8,6 +15,13 @@ def clones(module, N):
 
 
 
+@dataclass(frozen=True)
+class Out:
+    logit: torch.Tensor
+    loss: torch.Tensor
+
+
+
 class PositionalEncoding(nn.Module):
     def __init__(self, config):
         super(PositionalEncoding, self).__init__()
@@ -27,8 +41,10 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
         
 
-    def forward(self, x):
-        return x + self.pe[:, :x.size(1)]
+    def forward(self, x, pos=None):
+        if pos is None:
+            return x + self.pe[:, :x.size(1)]
+        return x + self.pe[0, pos]
 
 
 
@@ -48,9 +64,9 @@ class Embeddings(nn.Module):
             self.fc_dropout = nn.Dropout(config.dropout_ratio)
 
 
-    def forward(self, x):
+    def forward(self, x, pos=None):
         out = self.tok_emb(x) * self.scale
-        out = self.pos_dropout(self.pos_emb(out))
+        out = self.pos_dropout(self.pos_emb(out, pos))
 
         if not self.use_fc_layer:
             return out
@@ -58,25 +74,178 @@ class Embeddings(nn.Module):
 
 
 
-class Encoder(nn.Module):
+class MultiHeadAttention(nn.Module):
     def __init__(self, config):
-        super(Encoder, self).__init__()
+        super(MultiHeadAttention, self).__init__()
+
+        self.n_heads = config.n_heads
+        self.head_dim = config.hidden_dim // config.n_heads
+        self.dropout_ratio = config.dropout_ratio
+
+        #parameter names follow nn.MultiheadAttention to keep checkpoints compatible
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * config.hidden_dim, config.hidden_dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * config.hidden_dim))
+        self.out_proj = nn.Linear(config.hidden_dim, config.hidden_dim)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+
+
+    def split_heads(self, x):
+        batch_size, seq_len, _ = x.size()
+        return x.view(batch_size, seq_len, self.n_heads, self.head_dim).transpose(1, 2)
+
+
+    def merge_heads(self, x):
+        batch_size, _, seq_len, _ = x.size()
+        return x.transpose(1, 2).reshape(batch_size, seq_len, -1)
+
+
+    def project_qkv(self, x):
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        return self.split_heads(q), self.split_heads(k), self.split_heads(v)
 
-        layer = nn.TransformerEncoderLayer(
-            d_model=config.hidden_dim,
-            nhead=config.n_heads,
-            dim_feedforward=config.pff_dim,
-            dropout=config.dropout_ratio,
-            activation='gelu',
-            batch_first=True
+
+    def project_q(self, x):
+        d_model = x.size(-1)
+        q = F.linear(x, self.in_proj_weight[:d_model], self.in_proj_bias[:d_model])
+        return self.split_heads(q)
+
+
+    def project_kv(self, memory):
+        d_model = memory.size(-1)
+        k, v = F.linear(
+            memory, self.in_proj_weight[d_model:], self.in_proj_bias[d_model:]
+        ).chunk(2, dim=-1)
+        return self.split_heads(k), self.split_heads(v)
+
+
+    def attend(self, q, k, v, attn_mask=None, is_causal=False):
+        x = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            is_causal=is_causal,
+            dropout_p=self.dropout_ratio if self.training else 0.0
+        )
+        return self.out_proj(self.merge_heads(x))
+
+
+    def varlen_forward(self, x, cu_seqlens, max_seqlen, memory=None, cu_seqlens_k=None, max_seqlen_k=None, causal=False):
+        #x holds the unpadded tokens of the whole batch, cu_seqlens marks where each sequence starts
+        if memory is None:
+            q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).view(
+                x.size(0), 3, self.n_heads, self.head_dim
+            ).unbind(dim=1)
+            cu_seqlens_k, max_seqlen_k = cu_seqlens, max_seqlen
+        else:
+            d_model = x.size(-1)
+            q = F.linear(x, self.in_proj_weight[:d_model], self.in_proj_bias[:d_model]).view(
+                x.size(0), self.n_heads, self.head_dim
+            )
+            k, v = F.linear(memory, self.in_proj_weight[d_model:], self.in_proj_bias[d_model:]).view(
+                memory.size(0), 2, self.n_heads, self.head_dim
+            ).unbind(dim=1)
+
+        x = flash_attn_varlen_func(
+            q, k, v,
+            cu_seqlens, cu_seqlens_k,
+            max_seqlen, max_seqlen_k,
+            dropout_p=self.dropout_ratio if self.training else 0.0,
+            causal=causal
         )
+        return self.out_proj(x.reshape(x.size(0), -1))
+
+
+    def forward(self, x, memory=None, attn_mask=None, is_causal=False):
+        if memory is None:
+            q, k, v = self.project_qkv(x)
+        else:
+            q, (k, v) = self.project_q(x), self.project_kv(memory)
+        return self.attend(q, k, v, attn_mask, is_causal)
+
+
+
+class EncoderLayer(nn.Module):
+    def __init__(self, config):
+        super(EncoderLayer, self).__init__()
+
+        self.self_attn = MultiHeadAttention(config)
+
+        self.linear1 = nn.Linear(config.hidden_dim, config.pff_dim)
+        self.linear2 = nn.Linear(config.pff_dim, config.hidden_dim)
+
+        self.norm1 = nn.LayerNorm(config.hidden_dim)
+        self.norm2 = nn.LayerNorm(config.hidden_dim)
+
+        self.dropout = nn.Dropout(config.dropout_ratio)
+        self.dropout1 = nn.Dropout(config.dropout_ratio)
+        self.dropout2 = nn.Dropout(config.dropout_ratio)
+
+
+    def _sa_block(self, x, e_mask):
+        return self.dropout1(self.self_attn(x, attn_mask=e_mask))
+
+
+    def _ff_block(self, x):
+        x = self.linear2(self.dropout(F.gelu(self.linear1(x))))
+        return self.dropout2(x)
+
+
+    def forward(self, x, e_mask):
+        x = self.norm1(x + self._sa_block(x, e_mask))
+        return self.norm2(x + self._ff_block(x))
+
+
+    def varlen_forward(self, x, cu_seqlens, max_seqlen):
+        x = self.norm1(x + self.dropout1(self.self_attn.varlen_forward(x, cu_seqlens, max_seqlen)))
+        return self.norm2(x + self._ff_block(x))
+
+
+
+class Encoder(nn.Module):
+    def __init__(self, config):
+        super(Encoder, self).__init__()
 
         self.embeddings = Embeddings(config)
-        self.layers = clones(layer, config.n_layers)
+        self.layers = clones(EncoderLayer(config), config.n_layers)
+
+
+    @staticmethod
+    def can_unpad(x):
+        #flash attention needs half precision cuda inputs
+        is_half = x.dtype in (torch.float16, torch.bfloat16) or torch.is_autocast_enabled()
+        return flash_attn_varlen_func is not None and x.is_cuda and is_half
+
+
+    def varlen_forward(self, x, cu_seqlens, max_seqlen):
+        for layer in self.layers:
+            x = layer.varlen_forward(x, cu_seqlens, max_seqlen)
+        return x
+
+
+    def unpadded_forward(self, x, e_mask):
+        #padding is dropped once before the first layer and restored after the last one
+        batch_size, seq_len, hidden_dim = x.size()
+
+        keep = e_mask.view(batch_size, seq_len)
+        indices = keep.flatten().nonzero().squeeze(-1)
+        seqlens = keep.sum(dim=-1, dtype=torch.int32)
+        cu_seqlens = F.pad(seqlens.cumsum(dim=0, dtype=torch.int32), (1, 0))
+        max_seqlen = seqlens.max().item()
+
+        x = self.varlen_forward(x.reshape(-1, hidden_dim)[indices], cu_seqlens, max_seqlen)
+
+        out = x.new_zeros(batch_size * seq_len, hidden_dim)
+        out[indices] = x
+        return out.view(batch_size, seq_len, hidden_dim)
 
 
     def forward(self, x, e_mask):
         x = self.embeddings(x)
+
+        if self.can_unpad(x):
+            return self.unpadded_forward(x, e_mask)
+
         for layer in self.layers:
-            x = layer(x, src_key_padding_mask=e_mask)
+            x = layer(x, e_mask)
         return x
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
-from collections import namedtuple
-from .common import Embeddings, Encoder
+from .common import Out, Embeddings, Encoder
 
 
 
@@ -17,20 +16,16 @@ class Discriminator(nn.Module):
         self.dropout = nn.Dropout(config.dropout_ratio)
         self.fc_out = nn.Linear(config.hidden_dim, 1)
 
-        self.out = namedtuple('Out', 'logit loss')
         self.criterion = nn.BCEWithLogitsLoss()
 
 
 
     def forward(self, x, y=None):
-        x_mask = (x == self.pad_id)
+        x_mask = (x != self.pad_id)[:, None, None, :]
         x = self.encoder(x, x_mask)[:, 0, :]
         logit = self.fc_out(x).squeeze()
 
         if y is None:
             return logit
 
-        self.out.logit = logit
-        self.out.loss = self.criterion(logit, y)
-
-        return self.out
\ No newline at end of file
+        return Out(logit, self.criterion(logit, y))
\ No newline at end of file
@@ -1,7 +1,137 @@
 import torch
 import torch.nn as nn
-from collections import namedtuple
-from .common import clones, Embeddings, Encoder
+import torch.nn.functional as F
+from .common import clones, Out, Embeddings, MultiHeadAttention, Encoder, flash_attn_varlen_func
+
+
+
+
+class StaticKVCache(nn.Module):
+    def __init__(self, cache_shape, dtype, device, is_static=False):
+        super(StaticKVCache, self).__init__()
+
+        #cache_shape: (n_layers, batch_size, n_heads, max_len, head_dim)
+        #self attention k, v grow by one token per step, cross attention k, v are written once per source
+        for name in ['k_cache', 'v_cache', 'cross_k', 'cross_v']:
+            self.register_buffer(
+                name, torch.zeros(cache_shape, dtype=dtype, device=device), persistent=False
+            )
+
+        batch_size, max_len = cache_shape[1], cache_shape[3]
+        self.register_buffer(
+            'src_mask', torch.zeros(batch_size, 1, 1, max_len, dtype=torch.bool, device=device), persistent=False
+        )
+
+        #fixed addresses let cuda graphs read the cache in place instead of copying it,
+        #marked tensors stay alive until dynamo is reset, so only the compiled path asks for it
+        if is_static:
+            for buffer in self.buffers():
+                torch._dynamo.mark_static_address(buffer)
+
+
+    def fits(self, batch_size, dtype, device):
+        k_cache = self.k_cache
+        return batch_size <= k_cache.size(1) and k_cache.dtype == dtype and k_cache.device == device
+
+
+    def set_cross(self, cross_kv, e_mask):
+        #keys past the source length keep stale values, the cleared mask hides them
+        batch_size, src_len = e_mask.size(0), e_mask.size(-1)
+        self.src_mask[:batch_size].zero_()
+        self.src_mask[:batch_size, ..., :src_len].copy_(e_mask)
+
+        for layer_idx, (k, v) in enumerate(cross_kv):
+            self.cross_k[layer_idx, :batch_size, :, :src_len].copy_(k)
+            self.cross_v[layer_idx, :batch_size, :, :src_len].copy_(v)
+
+
+    def cross(self, layer_idx, batch_size):
+        return self.cross_k[layer_idx, :batch_size], self.cross_v[layer_idx, :batch_size]
+
+
+    def update(self, layer_idx, pos, k, v):
+        #write the new token slice in place, pos is a 0-dim LongTensor
+        batch_size = k.size(0)
+        k_cache, v_cache = self.k_cache[layer_idx, :batch_size], self.v_cache[layer_idx, :batch_size]
+        k_cache.index_copy_(2, pos.view(1), k)
+        v_cache.index_copy_(2, pos.view(1), v)
+        return k_cache, v_cache
+
+
+
+
+class DecoderLayer(nn.Module):
+    def __init__(self, config):
+        super(DecoderLayer, self).__init__()
+
+        self.self_attn = MultiHeadAttention(config)
+        self.multihead_attn = MultiHeadAttention(config)
+
+        self.linear1 = nn.Linear(config.hidden_dim, config.pff_dim)
+        self.linear2 = nn.Linear(config.pff_dim, config.hidden_dim)
+
+        self.norm1 = nn.LayerNorm(config.hidden_dim)
+        self.norm2 = nn.LayerNorm(config.hidden_dim)
+        self.norm3 = nn.LayerNorm(config.hidden_dim)
+
+        self.dropout = nn.Dropout(config.dropout_ratio)
+        self.dropout1 = nn.Dropout(config.dropout_ratio)
+        self.dropout2 = nn.Dropout(config.dropout_ratio)
+        self.dropout3 = nn.Dropout(config.dropout_ratio)
+
+
+    def _sa_block(self, x):
+        return self.dropout1(self.self_attn(x, is_causal=True))
+
+
+    def _cached_sa_block(self, x, kv_cache, layer_idx, pos, cache_mask):
+        q, k, v = self.self_attn.project_qkv(x)
+        k_cache, v_cache = kv_cache.update(layer_idx, pos, k, v)
+
+        #attend over the whole static cache, positions beyond pos are masked out
+        x = self.self_attn.attend(q, k_cache, v_cache, attn_mask=cache_mask)
+        return self.dropout1(x)
+
+
+    def _mha_block(self, x, memory, cross_mask):
+        return self.dropout2(self.multihead_attn(x, memory, attn_mask=cross_mask))
+
+
+    def _cached_mha_block(self, x, cross_kv, cross_mask):
+        q = self.multihead_attn.project_q(x)
+        return self.dropout2(self.multihead_attn.attend(q, *cross_kv, attn_mask=cross_mask))
+
+
+    def cross_kv(self, memory):
+        return self.multihead_attn.project_kv(memory)
+
+
+    def _ff_block(self, x):
+        x = self.linear2(self.dropout(F.gelu(self.linear1(x))))
+        return self.dropout3(x)
+
+
+    def forward(self, x, memory, cross_mask):
+        x = self.norm1(x + self._sa_block(x))
+        x = self.norm2(x + self._mha_block(x, memory, cross_mask))
+        return self.norm3(x + self._ff_block(x))
+
+
+    def varlen_forward(self, x, memory, cu_seqlens, max_seqlen, cu_seqlens_k, max_seqlen_k):
+        x = self.norm1(x + self.dropout1(
+            self.self_attn.varlen_forward(x, cu_seqlens, max_seqlen, causal=True)
+        ))
+        x = self.norm2(x + self.dropout2(
+            self.multihead_attn.varlen_forward(x, cu_seqlens, max_seqlen, memory, cu_seqlens_k, max_seqlen_k)
+        ))
+        return self.norm3(x + self._ff_block(x))
+
+
+    def step(self, x, kv_cache, layer_idx, pos, cache_mask, cross_mask):
+        cross_kv = kv_cache.cross(layer_idx, x.size(0))
+        x = self.norm1(x + self._cached_sa_block(x, kv_cache, layer_idx, pos, cache_mask))
+        x = self.norm2(x + self._cached_mha_block(x, cross_kv, cross_mask))
+        return self.norm3(x + self._ff_block(x))
 
 
 
@@ -10,23 +140,52 @@ class Decoder(nn.Module):
     def __init__(self, config):
         super(Decoder, self).__init__()
 
-        layer = nn.TransformerDecoderLayer(
-            d_model=config.hidden_dim,
-            nhead=config.n_heads,
-            dim_feedforward=config.pff_dim,
-            dropout=config.dropout_ratio,
-            activation='gelu',
-            batch_first=True
-        )
+        self.max_len = config.max_len
+        self.n_heads = config.n_heads
+        self.head_dim = config.hidden_dim // config.n_heads
 
         self.embeddings = Embeddings(config)
-        self.layers = clones(layer, config.n_layers)
+        self.layers = clones(DecoderLayer(config), config.n_layers)
+        self.kv_cache = None
+
+        self.register_buffer('cache_pos', torch.arange(config.max_len), persistent=False)
 
 
-    def forward(self, x, memory, e_mask, d_mask):
+    def setup_cache(self, batch_size, dtype, device, is_static=False):
+        #one cache is kept and only grown, smaller batches decode on a slice of it
+        if self.kv_cache is not None and self.kv_cache.fits(batch_size, dtype, device):
+            return
+
+        cache_shape = (len(self.layers), batch_size, self.n_heads, self.max_len, self.head_dim)
+        self.kv_cache = StaticKVCache(cache_shape, dtype, device, is_static)
+
+
+    def forward(self, x, memory, e_mask):
         x = self.embeddings(x)
         for layer in self.layers:
-            x = layer(x, memory, memory_key_padding_mask=e_mask, tgt_mask=d_mask)
+            x = layer(x, memory, e_mask)
+        return x
+
+
+    def varlen_forward(self, x, memory, cu_seqlens, max_seqlen, cu_seqlens_k, max_seqlen_k):
+        for layer in self.layers:
+            x = layer.varlen_forward(x, memory, cu_seqlens, max_seqlen, cu_seqlens_k, max_seqlen_k)
+        return x
+
+
+    def precompute_cross_kv(self, memory, e_mask):
+        #memory is fixed while decoding, so its cross attention k, v are projected once
+        cross_kv = [layer.cross_kv(memory) for layer in self.layers]
+        self.kv_cache.set_cross(cross_kv, e_mask)
+
+
+    def step(self, x, pos):
+        cache_mask = self.cache_pos <= pos
+        cross_mask = self.kv_cache.src_mask[:x.size(0)]
+
+        x = self.embeddings(x, pos.view(1))
+        for idx, layer in enumerate(self.layers):
+            x = layer.step(x, self.kv_cache, idx, pos, cache_mask, cross_mask)
         return x
 
 
@@ -38,44 +197,150 @@ class Generator(nn.Module):
 
         self.device = config.device
         self.pad_id = config.pad_id
+        self.bos_id = config.bos_id
+        self.eos_id = config.eos_id
+        self.max_len = config.max_len
         self.vocab_size = config.vocab_size
 
         self.encoder = Encoder(config)
         self.decoder = Decoder(config)
         self.generator = nn.Linear(config.hidden_dim, self.vocab_size)
 
-        self.out = namedtuple('Out', 'logit loss')
+        #one shared vocab matrix, the output head can only join when emb_dim matches
+        if config.tie_embeddings:
+            self.decoder.embeddings.tok_emb.weight = self.encoder.embeddings.tok_emb.weight
+            if config.emb_dim == config.hidden_dim:
+                self.generator.weight = self.encoder.embeddings.tok_emb.weight
+
         self.criterion = nn.CrossEntropyLoss()
 
+        #cross segment targets are set to pad_id in packed rows, they must not count toward the loss
+        self.pack_criterion = nn.CrossEntropyLoss(ignore_index=self.pad_id)
+
+        #packed rows run on the flash varlen kernels, which only exist for cuda
+        self.can_pack = flash_attn_varlen_func is not None and self.device.type == 'cuda'
+
+        #cuda graphs need static shapes, which the kv cache and 0-dim pos provide
+        self.use_compile = self.device.type == 'cuda'
+        if self.use_compile:
+            self._decode_step = torch.compile(
+                self._decode_step_impl, mode='reduce-overhead', fullgraph=True, dynamic=False
+            )
+        else:
+            self._decode_step = self._decode_step_impl
+
 
     @staticmethod
     def shift_y(y):
         return y[:, :-1], y[:, 1:]
 
 
-    def pad_mask(self, x):
-        return x == self.pad_id
+    def src_pad_mask(self, x):
+        #boolean sdpa mask, True marks the keys that can be attended
+        return (x != self.pad_id)[:, None, None, :]
+
 
+    @staticmethod
+    def seg_pos(seg):
+        #positions restart from zero at every segment boundary
+        pos = torch.arange(seg.size(1), device=seg.device).expand_as(seg)
+        is_start = torch.ones_like(seg, dtype=torch.bool)
+        is_start[:, 1:] = seg[:, 1:] != seg[:, :-1]
+        return pos - pos.masked_fill(~is_start, 0).cummax(dim=1).values
+
+
+    @staticmethod
+    def seg_lens(seg):
+        #segment ids restart every row, offsetting them by row gives one id per packed pair
+        keep = (seg != 0).flatten()
+        row_offset = torch.arange(seg.size(0), device=seg.device)[:, None] * (seg.size(1) + 1)
+        seg_ids = (seg + row_offset).flatten()[keep]
 
-    def dec_mask(self, x):
-        sz = x.size(1)
-        return torch.triu(torch.full((sz, sz), float('-inf')), diagonal=1).to(self.device)
+        seqlens = torch.unique_consecutive(seg_ids, return_counts=True)[1]
+        cu_seqlens = F.pad(seqlens.cumsum(dim=0, dtype=torch.int32), (1, 0))
+        return keep.nonzero().squeeze(-1), cu_seqlens, seqlens.max().item()
 
 
-    def forward(self, x, y):
+    def packed_forward(self, x, y, x_seg, y_seg):
         y, label = self.shift_y(y)
-        
-        e_mask = self.pad_mask(x)
-        d_mask = self.dec_mask(y)
+        y_seg, label_seg = self.shift_y(y_seg)
+
+        #the last token of a segment must not learn to predict the next segment
+        label = label.masked_fill(label_seg != y_seg, self.pad_id)
+
+        #pairs never share attention, so padding is dropped and every pair is its own varlen sequence
+        x_idx, x_cu_seqlens, x_max_seqlen = self.seg_lens(x_seg)
+        y_idx, y_cu_seqlens, y_max_seqlen = self.seg_lens(y_seg)
 
+        x = self.encoder.embeddings(x, self.seg_pos(x_seg)).flatten(0, 1)[x_idx]
+        memory = self.encoder.varlen_forward(x, x_cu_seqlens, x_max_seqlen)
+
+        y = self.decoder.embeddings(y, self.seg_pos(y_seg)).flatten(0, 1)[y_idx]
+        dec_out = self.decoder.varlen_forward(
+            y, memory, y_cu_seqlens, y_max_seqlen, x_cu_seqlens, x_max_seqlen
+        )
+
+        #logit stays flat, one row per unpadded target token
+        logit = self.generator(dec_out)
+        loss = self.pack_criterion(logit, label.flatten()[y_idx])
+
+        return Out(logit, loss)
+
+
+    def forward(self, x, y, x_seg=None, y_seg=None):
+        if x_seg is not None:
+            return self.packed_forward(x, y, x_seg, y_seg)
+
+        y, label = self.shift_y(y)
+
+        e_mask = self.src_pad_mask(x)
         memory = self.encoder(x, e_mask)
-        dec_out = self.decoder(y, memory, e_mask, d_mask)
+        dec_out = self.decoder(y, memory, e_mask)
         logit = self.generator(dec_out)
 
-        self.out.logit = logit
-        self.out.loss = self.criterion(
-            logit.contiguous().view(-1, self.vocab_size), 
+        loss = self.criterion(
+            logit.contiguous().view(-1, self.vocab_size),
             label.contiguous().view(-1)
         )
 
-        return self.out
+        return Out(logit, loss)
+
+
+    def prefill(self, x):
+        e_mask = self.src_pad_mask(x)
+        memory = self.encoder(x, e_mask)
+
+        #cross k, v and the source mask are copied into max_len wide cache buffers,
+        #so the compiled decode step sees the same shapes and addresses for every source
+        self.decoder.setup_cache(x.size(0), memory.dtype, memory.device, self.use_compile)
+        self.decoder.precompute_cross_kv(memory, e_mask)
+
+
+    def _decode_step_impl(self, tok, pos):
+        d_out = self.decoder.step(tok, pos)
+        return self.generator(d_out[:, -1]).argmax(dim=-1, keepdim=True)
+
+
+    def generate(self, x):
+        batch_size = x.size(0)
+        pred = torch.zeros((batch_size, self.max_len), dtype=torch.long, device=self.device)
+        pred[:, 0] = self.bos_id
+
+        self.prefill(x)
+
+        #position of the token being fed, advanced in place on device
+        pos = torch.zeros((), dtype=torch.long, device=self.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+        for idx in range(1, self.max_len):
+            #only the newest token is fed, previous ones live in the kv cache
+            next_tok = self._decode_step(pred[:, idx-1:idx], pos)
+            pos.add_(1)
+            pred.index_copy_(1, pos.view(1), next_tok)
+
+            #Early Stop Condition
+            finished |= next_tok.squeeze(1) == self.eos_id
+            if finished.all().item():
+                break
+
+        return pred
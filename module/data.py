@@ -1,7 +1,14 @@
-import json, torch
-from torch.utils.data import DataLoader
+import os, math, hashlib, torch
+import numpy as np
+from itertools import chain
+from torch.utils.data import DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -9,55 +16,178 @@ class Dataset(torch.utils.data.Dataset):
     def __init__(self, tokenizer, task, split):
         super().__init__()
         self.tokenizer = tokenizer
-        self.data = self.load_data(task, split)
+        self.ids, self.offsets = self.load_ids(task, split)
+        self.lengths = np.diff(self.offsets[::2]).tolist()
 
 
     @staticmethod
     def load_data(task, split):
-        with open(f"data/{task}/{split}.json", 'r') as f:
-            data = json.load(f)
+        with open(f"data/{task}/{split}.json", 'rb') as f:
+            data = json_loads(f.read())
         return data
 
 
+    def load_ids(self, task, split):
+        #token ids are cached next to the split and memory mapped on later runs
+        data_path = f"data/{task}/{split}.json"
+        ids_path = f"data/{task}/{split}_ids.npy"
+        offsets_path = f"data/{task}/{split}_offsets.npy"
+        key_path = f"data/{task}/{split}_ids.key"
+
+        #the serialized tokenizer covers its vocab and the bos/eos template attached in run.load_tokenizer
+        cache_key = hashlib.sha1(self.tokenizer.to_str().encode()).hexdigest()
+
+        is_stale = not os.path.exists(key_path) or \
+                   os.path.getmtime(data_path) > os.path.getmtime(key_path)
+        if not is_stale:
+            with open(key_path, 'r') as f:
+                is_stale = f.read() != cache_key
+
+        if is_stale:
+            ids, offsets = self.tokenize(self.load_data(task, split))
+            np.save(ids_path, ids)
+            np.save(offsets_path, offsets)
+            with open(key_path, 'w') as f:
+                f.write(cache_key)
+
+        return np.load(ids_path, mmap_mode='r'), np.load(offsets_path)
+
+
+    def tokenize(self, data):
+        #encode_batch runs across rust threads without the GIL
+        x_encoded = self.tokenizer.encode_batch([elem['x'] for elem in data])
+        y_encoded = self.tokenizer.encode_batch([elem['y'] for elem in data])
+
+        #x and y of each pair are interleaved, pair i spans offsets[2i:2i+3]
+        seqs = [seq.ids for pair in zip(x_encoded, y_encoded) for seq in pair]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+        ids = np.fromiter(chain.from_iterable(seqs), dtype=np.int32, count=offsets[-1])
+
+        return ids, offsets
+
+
     def __len__(self):
-        return len(self.data)
+        return len(self.offsets) // 2
     
 
     def __getitem__(self, idx):
-        x = self.tokenizer.encode(self.data[idx]['x']).ids
-        y = self.tokenizer.encode(self.data[idx]['y']).ids
-        return torch.LongTensor(x), torch.LongTensor(y)
+        x_start, y_start, y_end = self.offsets[2 * idx: 2 * idx + 3]
+        x = torch.from_numpy(self.ids[x_start:y_start].astype(np.int64))
+        y = torch.from_numpy(self.ids[y_start:y_end].astype(np.int64))
+        return x, y
 
 
 
 class Collator(object):
 
-    def __init__(self, pad_id):
+    def __init__(self, pad_id, max_tokens=None):
         self.pad_id = pad_id
+        self.max_tokens = max_tokens
 
 
     def __call__(self, batch):
         x_batch, y_batch = zip(*batch)     
 
+        if self.max_tokens:
+            return self.pack(x_batch, y_batch)
+
         return {'x': self.pad_batch(x_batch), 
                 'y': self.pad_batch(y_batch)}
 
 
-    def pad_batch(self, batch):
+    def pad_batch(self, batch, padding_value=None):
         return pad_sequence(
             batch, 
             batch_first=True, 
-            padding_value=self.pad_id
+            padding_value=self.pad_id if padding_value is None else padding_value
+        )
+
+
+    def pack(self, x_batch, y_batch):
+        order = sorted(
+            range(len(x_batch)), 
+            key=lambda i: len(x_batch[i]) + len(y_batch[i]), 
+            reverse=True
         )
 
+        #first fit decreasing into rows of max_tokens, each row is [x_len, y_len, indices]
+        #a pair longer than the budget still gets a row of its own
+        rows = []
+        for i in order:
+            x_len, y_len = len(x_batch[i]), len(y_batch[i])
+            for row in rows:
+                if row[0] + x_len <= self.max_tokens and row[1] + y_len <= self.max_tokens:
+                    row[0] += x_len
+                    row[1] += y_len
+                    row[2].append(i)
+                    break
+            else:
+                rows.append([x_len, y_len, [i]])
+
+        x_pack, y_pack, x_seg, y_seg = [], [], [], []
+        for _, _, indices in rows:
+            x_pack.append(torch.cat([x_batch[i] for i in indices]))
+            y_pack.append(torch.cat([y_batch[i] for i in indices]))
+
+            #segment ids start from 1, 0 is left for padding
+            x_seg.append(torch.cat([torch.full_like(x_batch[i], seg) for seg, i in enumerate(indices, 1)]))
+            y_seg.append(torch.cat([torch.full_like(y_batch[i], seg) for seg, i in enumerate(indices, 1)]))
+
+        return {'x': self.pad_batch(x_pack),
+                'y': self.pad_batch(y_pack),
+                'x_seg': self.pad_batch(x_seg, padding_value=0),
+                'y_seg': self.pad_batch(y_seg, padding_value=0)}
+
+
+
+class BucketSampler(Sampler):
+
+    def __init__(self, lengths, batch_size, bucket_size=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size or batch_size * 100
+
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+
+        #sort within random buckets, so each batch holds pairs of similar length
+        batches = []
+        for i in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[i:i + self.bucket_size], key=lambda idx: self.lengths[idx])
+            batches.extend(
+                bucket[j:j + self.batch_size] for j in range(0, len(bucket), self.batch_size)
+            )
+
+        for idx in torch.randperm(len(batches)).tolist():
+            yield batches[idx]
+
+
+    def __len__(self):
+        n_full, remainder = divmod(len(self.lengths), self.bucket_size)
+        n_batches = n_full * math.ceil(self.bucket_size / self.batch_size)
+        return n_batches + math.ceil(remainder / self.batch_size)
+
+
+
+def load_dataloader(config, tokenizer, split, pack_batch=False):
+    dataset = Dataset(tokenizer, config.task, split)
+
+    #batch_sampler excludes batch_size and shuffle
+    if 'train' in split:
+        loader_kwargs = {'batch_sampler': BucketSampler(dataset.lengths, config.batch_size)}
+    else:
+        loader_kwargs = {'batch_size': config.batch_size, 'shuffle': False}
 
+    #keep workers alive across epochs and batches queued ahead of the gpu
+    if config.num_workers > 0:
+        loader_kwargs.update({'persistent_workers': True, 'prefetch_factor': 4})
 
-def load_dataloader(config, tokenizer, split):
     return DataLoader(
-        Dataset(tokenizer, config.task, split), 
-        batch_size=config.batch_size, 
-        shuffle='train' in split,
-        collate_fn=Collator(config.pad_id),
+        dataset, 
+        collate_fn=Collator(config.pad_id, config.max_tokens if pack_batch else None),
         pin_memory=True,
-        num_workers=2
+        num_workers=config.num_workers,
+        **loader_kwargs
     )
\ No newline at end of file
@@ -48,7 +48,7 @@ class Inferencer:
 
     def generate(self, input_sequence):
         input_tensor = self.tokenizer.encode(input_sequence).ids
-        input_tensor = torch.LongTensor(input_tensor).to(self.device)
+        input_tensor = torch.LongTensor([input_tensor]).to(self.device)
 
         with torch.no_grad():
             if self.search_method == 'greedy':
@@ -61,25 +61,7 @@ class Inferencer:
 
 
     def greedy_search(self, input_tensor):
-        output = torch.LongTensor([[self.bos_id]]).to(self.device)
-
-        e_mask = self.model.pad_mask(input_tensor)
-        memory = self.model.encoder(input_tensor, e_mask)        
-
-        
-        for i in range(1, self.max_len):
-            #Masking
-            d_mask = self.model.dec_mask(output)
-
-            dec_out = self.model.decoder(output, memory, e_mask, d_mask)            
-            logit = self.model.generator(dec_out)
-            
-            next_token = logit[:, -1].argmax(-1).unsqueeze(0)
-            output = torch.cat([output, next_token], dim=1)
-
-            if next_token == self.eos_id:
-                break
-
+        output = self.model.generate(input_tensor)
         return output.squeeze(0).tolist()
 
 
@@ -128,7 +110,7 @@ class Inferencer:
     def beam_search(self, input_tensor):
         Node, nodes, end_nodes = self.init_nodes()
 
-        e_mask = self.model.pad_mask(input_tensor)
+        e_mask = self.model.src_pad_mask(input_tensor)
         memory = self.model.encoder(input_tensor, e_mask)
 
         for t in range(self.max_len):
@@ -140,10 +122,8 @@ class Inferencer:
                     continue
 
                 d_input = torch.LongTensor([curr_node.pred]).to(self.device)
-                d_mask = self.model.dec_mask(d_input)
-
-                d_out = self.model.decoder(d_input, memory, e_mask, d_mask)                                           
-                out = self.model.generator(d_out)[:, -1]
+                d_out = self.model.decoder(d_input, memory, e_mask)
+                out = self.model.generator(d_out[:, -1])
                 
                 logits, preds = torch.topk(out, self.beam_size)
                 log_probs = torch.log_softmax(logits, dim=-1)
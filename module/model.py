@@ -35,6 +35,18 @@ def print_model_desc(model):
 
 
 
+def check_tied_weights(model, model_state):
+    #tied entries share one tensor, so loading differing values would silently keep only the last
+    tied = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        tied.setdefault(id(param), []).append(name)
+
+    for names in tied.values():
+        assert all(torch.equal(model_state[names[0]], model_state[name]) for name in names[1:]), \
+            f"Checkpoint holds untied weights for {names}, set tie_embeddings to False to load it"
+
+
+
 def load_model(config, model_type):
     model = Generator(config) if model_type == 'gen' else Discriminator(config)
     init_weights(model)
@@ -54,6 +66,7 @@ def load_model(config, model_type):
         ckpt, map_location=config.device
     )['model_state_dict']
 
+    check_tied_weights(model, model_state)
     model.load_state_dict(model_state)
 
     print(f"Model States has loaded from {ckpt}")
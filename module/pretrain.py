@@ -1,18 +1,19 @@
-import json, torch
+import json, torch, contextlib
 import torch.nn as nn
 from .train import TrainerBase
 
 
 
 class PreTrainer(TrainerBase):
-    def __init__(self, config, generator, discriminator, train_dataloader, valid_dataloader):
+    def __init__(self, config, generator, discriminator, train_dataloader, valid_dataloader, pack_dataloader=None):
         super(PreTrainer, self).__init__(config, generator, discriminator, train_dataloader, valid_dataloader)
 
+        #packed rows serve generator pretraining only, the discriminator needs one pair per row
+        self.pack_dataloader = pack_dataloader
+
         self.early_stop = config.early_stop
         self.patience = config.patience
         
-        self.device_type = config.device_type
-        self.scaler = torch.cuda.amp.GradScaler()
         self.iters_to_accumulate = config.iters_to_accumulate
         
         self.set_training_attrs(generator, 'pre_gen')
@@ -51,6 +52,10 @@ class PreTrainer(TrainerBase):
     
     def train(self):
         self.train_model(self.generator, 'pre_gen')
+
+        #dropping the last reference to the packed loader shuts its persistent workers down
+        self.pack_dataloader = None
+
         self.load_pt_generator()
         self.train_model(self.discriminator, 'pre_dis')
 
@@ -116,21 +121,33 @@ class PreTrainer(TrainerBase):
 
     def train_epoch(self, model, optimizer, model_type):
         model.train()
-        tot_len = len(self.train_dataloader)
         epoch_loss = 0
 
-        for idx, batch in enumerate(self.train_dataloader):
+        dataloader = self.train_dataloader
+        if model_type == 'pre_gen' and self.pack_dataloader is not None:
+            dataloader = self.pack_dataloader
+        tot_len = len(dataloader)
+
+        for idx, batch in enumerate(dataloader):
             idx += 1
             inputs = self.batch2inputs(batch, model_type)
+            is_update_step = (idx % self.iters_to_accumulate == 0) or (idx == tot_len)
 
-            with torch.autocast(device_type=self.device_type, dtype=torch.float16):
-                loss = model(**inputs).loss
-                loss = loss / self.iters_to_accumulate
+            #under DDP, skip the gradient allreduce on accumulation only micro batches
+            if is_update_step or not hasattr(model, 'no_sync'):
+                sync_context = contextlib.nullcontext()
+            else:
+                sync_context = model.no_sync()
+
+            with sync_context:
+                with torch.autocast(device_type=self.device_type, dtype=torch.float16):
+                    loss = model(**inputs).loss
+                    loss = loss / self.iters_to_accumulate
 
-            #Backward Loss
-            self.scaler.scale(loss).backward()
+                #Backward Loss
+                self.scaler.scale(loss).backward()
 
-            if (idx % self.iters_to_accumulate == 0) or (idx == tot_len):
+            if is_update_step:
                 #Gradient Clipping
                 self.scaler.unscale_(optimizer)
                 nn.utils.clip_grad_norm_(model.parameters(), max_norm=self.clip)
@@ -20,6 +20,9 @@ class TrainerBase:
         self.device = config.device
         self.n_epochs = config.n_epochs        
 
+        self.device_type = config.device_type
+        self.scaler = torch.cuda.amp.GradScaler()
+
         self.generator = generator
         self.discriminator = discriminator
         self.train_dataloader = train_dataloader
@@ -27,7 +30,8 @@ class TrainerBase:
 
 
     def set_training_attrs(self, model, prefix):
-        optimizer = AdamW(model.parameters(), lr=self.lr)
+        #fused kernel updates all params in one launch, it only exists for cuda tensors
+        optimizer = AdamW(model.parameters(), lr=self.lr, fused=self.device_type == 'cuda')
         scheduler = ReduceLROnPlateau(optimizer, patience=2)
 
         setattr(self, f'{prefix}_optimizer', optimizer)
@@ -50,10 +54,15 @@ class TrainerBase:
 
 
     def batch2inputs(self, batch, model_type):        
-        x = batch['y'].to(self.device)
-        y = batch['x'].to(self.device)
+        x = batch['y'].to(self.device, non_blocking=True)
+        y = batch['x'].to(self.device, non_blocking=True)
         
         if 'gen' in model_type:
+            #packed batches only come from the generator pretraining loader
+            if 'x_seg' in batch:
+                return {'x': x, 'y': y,
+                        'x_seg': batch['y_seg'].to(self.device, non_blocking=True),
+                        'y_seg': batch['x_seg'].to(self.device, non_blocking=True)}
             return {'x': x, 'y':y}
         
         batch_size = x.size(0)
@@ -198,18 +207,22 @@ class Trainer(TrainerBase):
 
         for batch in self.train_dataloader:
             
-            gen_loss, dis_loss = self.get_losses(batch)
+            with torch.autocast(device_type=self.device_type, dtype=torch.float16):
+                gen_loss, dis_loss = self.get_losses(batch)
 
+            #only the discriminator loss backpropagates through half precision activations
             gen_loss.backward()
-            dis_loss.backward()
+            self.scaler.scale(dis_loss).backward()
 
             #Gradient Clipping
+            self.scaler.unscale_(self.dis_optimizer)
             nn.utils.clip_grad_norm_(self.generator.parameters(), max_norm=self.clip)
             nn.utils.clip_grad_norm_(self.discriminator.parameters(), max_norm=self.clip)
 
             #Gradient Update & Scaler Update
             self.gen_optimizer.step()
-            self.dis_optimizer.step()
+            self.scaler.step(self.dis_optimizer)
+            self.scaler.update()
 
             self.gen_optimizer.zero_grad()
             self.dis_optimizer.zero_grad()
@@ -227,7 +240,8 @@ class Trainer(TrainerBase):
 
         with torch.no_grad():
             for batch in self.valid_dataloader:
-                gen_loss, dis_loss = self.get_losses(batch)
+                with torch.autocast(device_type=self.device_type, dtype=torch.float16):
+                    gen_loss, dis_loss = self.get_losses(batch)
 
                 gen_epoch_loss += gen_loss.item()
                 dis_epoch_loss += dis_loss.item()
@@ -14,7 +14,7 @@ from module import (
 
 
 
-def set_seed(SEED=42):
+def set_seed(SEED=42, deterministic=False):
     import random
     import numpy as np
     import torch.backends.cudnn as cudnn
@@ -24,8 +24,10 @@ def set_seed(SEED=42):
     torch.manual_seed(SEED)
     torch.cuda.manual_seed(SEED)
     torch.cuda.manual_seed_all(SEED)
-    cudnn.benchmark = False
-    cudnn.deterministic = True
+
+    #deterministic kernels give reproducible runs, benchmark lets cudnn pick faster ones
+    cudnn.benchmark = not deterministic
+    cudnn.deterministic = deterministic
 
 
 
@@ -80,7 +82,7 @@ def load_tokenizer(config):
 
 
 def main(args):
-    set_seed(42)
+    set_seed(42, args.deterministic)
     mode = args.mode
     config = Config(args)    
     
@@ -101,7 +103,17 @@ def main(args):
             'valid_dataloader': valid_dataloader
         }
 
-        trainer = Trainer(**trainer_args) if mode == 'train' else PreTrainer(**trainer_args)
+        if mode == 'train':
+            trainer = Trainer(**trainer_args)
+        else:
+            #packing relies on the flash varlen kernels, without them pre_gen keeps padded batches
+            #the trainer holds the only reference, so it can shut the packed workers down after pre_gen
+            trainer = PreTrainer(
+                **trainer_args,
+                pack_dataloader=load_dataloader(config, tokenizer, 'train', pack_batch=True) \
+                                if config.pack_batch and generator.can_pack else None
+            )
+
         trainer.train()
 
     elif config.mode == 'test':
@@ -124,6 +136,7 @@ if __name__ == '__main__':
     parser.add_argument('-task', required=True)
     parser.add_argument('-mode', required=True)
     parser.add_argument('-search', default='greedy', required=False)
+    parser.add_argument('-deterministic', action='store_true')
 
     args = parser.parse_args()
     assert args.task.lower() in ['translation', 'dialogue']